@@ -0,0 +1,125 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats
+from scipy.cluster.hierarchy import cophenet
+
+import utils
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_pearson_correlation_symmetric(dtype):
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(30, 600)).astype(dtype)
+    expected = np.corrcoef(x, rowvar=False)
+    tol = 1e-4 if dtype == np.float32 else 1e-10
+    np.testing.assert_allclose(utils.pearson_correlation(x, x), expected, atol=tol)
+    np.testing.assert_allclose(utils.correlations_list(x, x), expected[np.triu_indices(600, k=1)], atol=tol)
+    df = pd.DataFrame(x)
+    np.testing.assert_allclose(utils.pearson_correlation(df, df), expected, atol=tol)
+
+
+def test_gamma_coefficients_standardized():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(40, 50))
+    z = x + rng.normal(size=(40, 50))
+    expected = utils.gamma_coefficients(x, z)
+    gammas = utils.gamma_coefficients(utils.standardize(x), utils.standardize(z), standardized=True)
+    np.testing.assert_allclose(gammas, expected)
+    dists_x = 1 - utils.correlations_list(x, x)
+    assert expected[1] == pytest.approx(cophenet(utils.hierarchical_clustering(x), dists_x)[0])
+
+
+@pytest.fixture(params=['numba', 'numpy'])
+def kernel(request, monkeypatch):
+    if request.param == 'numba':
+        if utils.njit is None:
+            pytest.skip('numba is not installed')
+    else:
+        monkeypatch.setattr(utils, 'njit', None)
+    monkeypatch.setattr(utils, 'simsimd', None)
+    return request.param
+
+
+def test_cosine_similarities_degenerate_segments(kernel):
+    flat_x = np.array([0., 0., 1., 2., np.nan, 1.])
+    flat_z = np.array([1., 1., 1., 2., 1., 1.])
+    offsets = np.array([0, 2, 4, 6])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sims = utils._cosine_similarities(flat_x, flat_z, offsets)
+    assert np.isnan(sims[0])
+    assert sims[1] == pytest.approx(1.)
+    assert np.isnan(sims[2])
+
+
+def test_cosine_similarity_degenerate_vectors(kernel):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        assert np.isnan(utils.cosine_similarity(np.zeros(3), np.ones(3)))
+        assert np.isnan(utils.cosine_similarity(np.array([np.nan, 1., 2.]), np.ones(3)))
+    assert utils.cosine_similarity(np.array([1., 2.]), np.array([2., 4.])) == pytest.approx(1.)
+
+
+def test_cosine_similarity_mismatched_lengths(kernel):
+    with pytest.raises(ValueError):
+        utils.cosine_similarity(np.ones(5), np.ones(3))
+
+
+def test_psi_phi_coefficients_reject_misaligned_pairs():
+    with pytest.raises(ValueError):
+        utils.psi_coefficient([[1, 2, 3], [4, 5]], [[1, 2], [4, 5, 6]])
+    with pytest.raises(ValueError):
+        utils.phi_coefficient([[], [4, 5, 6]], [[1.], [4, 5, 6]])
+
+
+@pytest.mark.parametrize('nb_tgs', [3, 8, 20])
+def test_rank_sum_p_values_match_mannwhitneyu(nb_tgs):
+    rng = np.random.default_rng(0)
+    expr = rng.normal(size=(12, 60))
+    expr[:6, :10] = np.round(expr[:6, :10])  # Ties in half of the samples
+    expr[:, :nb_tgs] += 1
+    idxs = np.arange(nb_tgs)
+    ranks = scipy.stats.rankdata(expr, axis=1)
+
+    p_values = utils._rank_sum_p_values(ranks, idxs, utils._rank_sum_var_base(ranks))
+    expected = [scipy.stats.mannwhitneyu(e[:nb_tgs], e[nb_tgs:], alternative='two-sided').pvalue
+                for e in expr]
+    np.testing.assert_allclose(p_values, expected)
+
+
+def test_score_tf_counts_repeated_tgs_once():
+    rng = np.random.default_rng(0)
+    ranks = scipy.stats.rankdata(rng.normal(size=(12, 30)), axis=1)
+    var_base = utils._rank_sum_var_base(ranks)
+    sym2idx = {'g{}'.format(i): i for i in range(30)}
+    expected = utils._score_tf('g0', ['g1', 'g2', 'g3'], ranks, var_base, sym2idx)
+    assert utils._score_tf('g0', ['g1', 'g2', 'g2', 'g3', 'g1'], ranks, var_base, sym2idx) == expected
+    assert expected[1] == 3
+
+
+def test_plot_kdes_skips_zero_variance_data():
+    ax = plt.figure().gca()
+    utils._plot_kdes([np.ones(5), np.arange(5.)], ['constant', 'range'], [{}, {}], ax=ax)
+    assert [line.get_label() for line in ax.lines] == ['range']
+    plt.close('all')
+
+
+@pytest.mark.parametrize('x, y', [
+    ([0., 0., 0.], [1., 1., 1.]),
+    ([0., 0., 0.], [0., 0., 0.]),
+    ([np.nan, 1., 2.], [1., 1., 1.]),
+    ([np.inf, 1., 2.], [1., 1., 1.]),
+    ([1., 2., 3.], [3., 1., 2.]),
+])
+def test_cosine_similarity_dispatch_paths_agree(x, y, monkeypatch):
+    x = np.array(x, dtype=np.float32)
+    y = np.array(y, dtype=np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sims = [utils.cosine_similarity(x, y)]
+        monkeypatch.setattr(utils, 'simsimd', None)
+        sims.append(utils.cosine_similarity(x, y))
+        monkeypatch.setattr(utils, 'njit', None)
+        sims.append(utils.cosine_similarity(x, y))
+    np.testing.assert_allclose(sims, sims[-1], rtol=1e-6)
@@ -1,16 +1,31 @@
 import os
+import math
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.manifold import TSNE
 from scipy.cluster.hierarchy import linkage, cophenet, dendrogram
+from scipy.spatial.distance import squareform
+from scipy.linalg import get_blas_funcs
 import pickle
 import random
 from statsmodels.stats.multitest import multipletests
 from matplotlib.collections import EllipseCollection
+from joblib import Parallel, delayed
 import scipy
 
+try:
+    from numba import njit, prange
+except ImportError:  # Optional: the NumPy implementations are used instead
+    njit = None
+
+try:
+    import simsimd
+except ImportError:  # Optional: used for float32 cosine similarities when installed
+    simsimd = None
+
 RNAS_DIR = 'data/RNAseqDB/normalized'
 RNAS_EXPR_FILE = '{}/{}'.format(RNAS_DIR, '_expr.csv')
 RNAS_INFO_FILE = '{}/{}'.format(RNAS_DIR, '_info.csv')
@@ -805,25 +820,49 @@ def tf_tg_interactions(tf_tg_file=ECOLI_DEFAULT_TF_TG, minimum_evidence=ECOLI_DE
 # CORRELATION UTILITIES
 # ---------------------
 
-def pearson_correlation(x, y):
+def pearson_correlation(x, y, standardized=False):
     """
     Computes similarity measure between each pair of genes in the bipartite graph x <-> y
     :param x: Gene matrix 1. Shape=(nb_samples, nb_genes_1)
     :param y: Gene matrix 2. Shape=(nb_samples, nb_genes_2)
+    :param standardized: whether x and y are already standardized (zero mean and unit variance genes)
     :return: Matrix with shape (nb_genes_1, nb_genes_2) containing the similarity coefficients
     """
-
-    def standardize(a):
-        a_off = np.mean(a, axis=0)
-        a_std = np.std(a, axis=0)
-        return (a - a_off) / a_std
-
     assert x.shape[0] == y.shape[0]
-    x_ = standardize(x)
-    y_ = standardize(y)
+    x_ = x if standardized else standardize(x)
+    if x is y and x.ndim == 2:
+        corr = _syrk_upper(np.asarray(x_))
+        _mirror_upper(corr)
+        return corr
+    y_ = y if standardized else standardize(y)
     return np.dot(x_.T, y_) / x.shape[0]
 
 
+def _syrk_upper(x_):
+    """
+    Computes x_^T x_ / nb_samples with BLAS syrk, at half the cost of the full product
+    :param x_: standardized gene matrix. Shape=(nb_samples, nb_genes)
+    :return: C-ordered matrix whose upper-diagonal (diagonal included) is valid. Shape=(nb_genes, nb_genes)
+    """
+    syrk = get_blas_funcs('syrk', (x_,))
+    # syrk returns a Fortran-ordered matrix: its lower-diagonal is the upper-diagonal of the C-ordered transpose
+    return syrk(alpha=1.0 / x_.shape[0], a=x_.T, trans=0, lower=1).T
+
+
+def _mirror_upper(c, block=256):
+    """
+    Copies the upper-diagonal of c into its lower-diagonal in place, block by block
+    :param c: square matrix whose upper-diagonal is valid. Shape=(N, N)
+    :param block: number of rows per block
+    """
+    n = c.shape[0]
+    for i0 in range(0, n, block):
+        c[i0:i0 + block, :i0] = c[:i0, i0:i0 + block].T
+        diag = c[i0:i0 + block, i0:i0 + block]
+        lower = np.tril_indices(diag.shape[0], k=-1)
+        diag[lower] = diag.T[lower]
+
+
 def cosine_similarity(x, y):
     """
     Computes cosine similarity between vectors x and y
@@ -831,9 +870,88 @@ def cosine_similarity(x, y):
     :param y: Array of numbers. Shape=(n,)
     :return: cosine similarity between vectors
     """
+    if simsimd is not None and _is_contiguous_f32(x) and _is_contiguous_f32(y):
+        # SIMD kernels selected at runtime (AVX-512, AVX2, NEON...). simsimd.cosine returns finite values for
+        # zero or non-finite vectors, so the similarity is built from dot products to get NaN as with NumPy
+        norms = math.sqrt(simsimd.dot(x, x) * simsimd.dot(y, y))
+        return simsimd.dot(x, y) / norms if norms > 0 else math.nan
+    if njit is not None:
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        if x.shape != y.shape:  # The kernel does not check bounds
+            raise ValueError('shapes {} and {} not aligned'.format(x.shape, y.shape))
+        return _cosine_kernel(x, y)
     return np.dot(x, y) / (np.linalg.norm(x) * np.linalg.norm(y))
 
 
+def _is_contiguous_f32(a):
+    """
+    Whether a is a C-contiguous float32 numpy array, as required by simsimd
+    """
+    return isinstance(a, np.ndarray) and a.dtype == np.float32 and a.flags.c_contiguous
+
+
+if njit is not None:
+    # error_model='numpy' and no fastmath, so that zero and NaN inputs give NaN as in the NumPy implementation
+    @njit(error_model='numpy', cache=True)
+    def _cosine_kernel(x, y):
+        # Single pass over both vectors
+        d = 0.0
+        nx = 0.0
+        ny = 0.0
+        for i in range(x.size):
+            d += x[i] * y[i]
+            nx += x[i] * x[i]
+            ny += y[i] * y[i]
+        return d / (math.sqrt(nx) * math.sqrt(ny))
+
+
+    @njit(parallel=True, error_model='numpy', cache=True)
+    def _segment_cosine_kernel(flat_x, flat_z, offsets):
+        # Cosine similarity of each segment flat_x[offsets[s]:offsets[s+1]] vs. flat_z[offsets[s]:offsets[s+1]]
+        nb_segments = offsets.size - 1
+        sims = np.empty(nb_segments)
+        for s in prange(nb_segments):
+            sims[s] = _cosine_kernel(flat_x[offsets[s]:offsets[s + 1]], flat_z[offsets[s]:offsets[s + 1]])
+        return sims
+
+
+def _flatten_pairs(list_x, list_z):
+    """
+    Flattens two lists of paired vectors into two contiguous buffers. Empty pairs are skipped
+    :param list_x: list of arrays of numbers
+    :param list_z: list of arrays of numbers, with the same lengths as the ones in list_x
+    :return: tuple (flat_x, flat_z, offsets, sizes), where the i-th pair is flat_x[offsets[i]:offsets[i+1]] and
+             flat_z[offsets[i]:offsets[i+1]], with sizes[i] elements
+    """
+    pairs = [(cx, cz) for cx, cz in zip(list_x, list_z) if len(cx) > 0 or len(cz) > 0]
+    sizes = np.fromiter((len(cx) for cx, _ in pairs), dtype=np.int64, count=len(pairs))
+    sizes_z = np.fromiter((len(cz) for _, cz in pairs), dtype=np.int64, count=len(pairs))
+    if np.any(sizes != sizes_z):
+        raise ValueError('Paired vectors must have the same lengths')
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    flat_x = np.concatenate([np.empty(0)] + [np.asarray(cx, dtype=np.float64) for cx, _ in pairs])
+    flat_z = np.concatenate([np.empty(0)] + [np.asarray(cz, dtype=np.float64) for _, cz in pairs])
+    return flat_x, flat_z, offsets, sizes
+
+
+def _cosine_similarities(flat_x, flat_z, offsets):
+    """
+    Computes the cosine similarity between each pair of vectors of the buffers returned by _flatten_pairs at once
+    :param flat_x: concatenation of non-empty arrays of numbers
+    :param flat_z: concatenation of arrays of numbers, with the same lengths as the ones in flat_x
+    :param offsets: start of each array in the buffers, followed by the length of the buffers
+    :return: np.array of cosine similarities. Shape=(len(offsets) - 1,)
+    """
+    if njit is not None:
+        return _segment_cosine_kernel(flat_x, flat_z, offsets)
+
+    starts = offsets[:-1]
+    dots = np.add.reduceat(flat_x * flat_z, starts)
+    norms_x = np.sqrt(np.add.reduceat(flat_x * flat_x, starts))
+    norms_z = np.sqrt(np.add.reduceat(flat_z * flat_z, starts))
+    return dots / (norms_x * norms_z)
+
+
 def upper_diag_list(m_):
     """
     Returns the condensed list of all the values in the upper-diagonal of m_
@@ -841,12 +959,7 @@ def upper_diag_list(m_):
     :return: list of values in the upper-diagonal of m_ (from top to bottom and from
              left to right). Shape=(N*(N-1)/2,)
     """
-    m = np.triu(m_, k=1)  # upper-diagonal matrix
-    tril = np.zeros_like(m_) + np.nan
-    tril = np.tril(tril)
-    m += tril
-    m = np.ravel(m)
-    return m[~np.isnan(m)]
+    return m_[np.triu_indices(m_.shape[0], k=1)]
 
 
 def correlations_list(x, y, corr_fn=pearson_correlation):
@@ -856,10 +969,22 @@ def correlations_list(x, y, corr_fn=pearson_correlation):
     :param y: Gene matrix 2. Shape=(nb_samples, nb_genes_2)
     :param corr_fn: correlation function taking x and y as inputs
     """
+    if corr_fn is pearson_correlation and x is y and x.ndim == 2:
+        return _symmetric_correlations_list(x)
     corr = corr_fn(x, y)
     return upper_diag_list(corr)
 
 
+def _symmetric_correlations_list(x, standardized=False):
+    """
+    Generates the correlation list of correlations_list(x, x) straight from the upper-diagonal computed by syrk
+    :param x: Gene matrix. Shape=(nb_samples, nb_genes)
+    :param standardized: whether x is already standardized (zero mean and unit variance genes)
+    """
+    x_ = x if standardized else standardize(x)
+    return upper_diag_list(_syrk_upper(np.asarray(x_)))
+
+
 def gamma_coef(x, y):
     """
     Compute gamma coefficients for two given expression matrices
@@ -873,11 +998,12 @@ def gamma_coef(x, y):
     return gamma_dx_dy
 
 
-def gamma_coefficients(expr_x, expr_z):
+def gamma_coefficients(expr_x, expr_z, standardized=False):
     """
     Compute gamma coefficients for two given expression matrices
     :param expr_x: matrix of gene expressions. Shape=(nb_samples_1, nb_genes)
     :param expr_z: matrix of gene expressions. Shape=(nb_samples_2, nb_genes)
+    :param standardized: whether expr_x and expr_z are already standardized (zero mean and unit variance genes)
     :return: Gamma(D^X, D^Z), Gamma(D^X, T^X), Gamma(D^Z, T^Z), Gamma(T^X, T^Z)
              where D^X and D^Z are the distance matrices of expr_x and expr_z (respectively),
              and T^X and T^Z are the dendrogrammatic distance matrices of expr_x and expr_z (respectively).
@@ -885,16 +1011,16 @@ def gamma_coefficients(expr_x, expr_z):
              of A and B.
     """
     # Compute Gamma(D^X, D^Z)
-    dists_x = 1 - correlations_list(expr_x, expr_x)
-    dists_z = 1 - correlations_list(expr_z, expr_z)
+    dists_x = 1 - _symmetric_correlations_list(expr_x, standardized)
+    dists_z = 1 - _symmetric_correlations_list(expr_z, standardized)
     gamma_dx_dz = pearson_correlation(dists_x, dists_z)
 
-    # Compute Gamma(D^X, T^X)
-    xl_matrix = hierarchical_clustering(expr_x)
+    # Compute Gamma(D^X, T^X). The hierarchical clustering is built from the same distances
+    xl_matrix = linkage(dists_x, 'complete')
     gamma_dx_tx, _ = cophenet(xl_matrix, dists_x)
 
     # Compute Gamma(D^Z, T^Z)
-    zl_matrix = hierarchical_clustering(expr_z)
+    zl_matrix = linkage(dists_z, 'complete')
     gamma_dz_tz, _ = cophenet(zl_matrix, dists_z)
 
     # Compute Gamma(T^X, T^Z)
@@ -903,35 +1029,64 @@ def gamma_coefficients(expr_x, expr_z):
     return gamma_dx_dz, gamma_dx_tx, gamma_dz_tz, gamma_tx_tz
 
 
-def compute_tf_tg_corrs(expr, gene_symbols, tf_tg=None, flat=True):
+def _tf_tg_corrs(tf, tgs, expr_std, sym2idx):
+    """
+    Computes the TF-TG and TG-TG correlations of a single TF
+    :param tf: TF symbol
+    :param tgs: list of TGs' symbols regulated by tf
+    :param expr_std: matrix of standardized gene expressions. Shape=(nb_samples, nb_genes)
+    :param sym2idx: dict with gene symbol as key and its index in expr_std as value
+    :return: arrays of TF-TG and TG-TG correlations, or None if tf or all its TGs are not in sym2idx
+    """
+    tg_idxs = np.fromiter((sym2idx[tg] for tg in tgs if tg in sym2idx), dtype=np.intp)
+    if tf not in sym2idx or len(tg_idxs) == 0:
+        return None
+    nb_samples = expr_std.shape[0]
+
+    # TG-TG correlations
+    std_tgs = expr_std[:, tg_idxs]
+    tg_tg_corr = upper_diag_list(np.dot(std_tgs.T, std_tgs) / nb_samples)
+
+    # TF-TG correlations
+    std_tf = expr_std[:, sym2idx[tf]]
+    tf_tg_corr = np.dot(std_tf, std_tgs) / nb_samples
+
+    return tf_tg_corr, tg_tg_corr
+
+
+def _tf_tg_corr_arrays(expr, gene_symbols, tf_tg, standardized=False, n_jobs=-1):
+    """
+    Computes the TF-TG and TG-TG correlations of each TF. See compute_tf_tg_corrs
+    :return: lists with one array of TF-TG correlations and one array of TG-TG correlations per TF, respectively
+    """
+    sym2idx = {s: i for i, s in enumerate(gene_symbols)}
+
+    # Standardize all genes once. The correlations within any subset of genes are then products of its columns
+    expr_std = expr if standardized else standardize(expr)
+
+    # TFs are independent from each other
+    results = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(_tf_tg_corrs)(tf, tgs, expr_std, sym2idx)
+                                                        for tf, tgs in tf_tg.items())
+    results = [r for r in results if r is not None]
+    return [r[0] for r in results], [r[1] for r in results]
+
+
+def compute_tf_tg_corrs(expr, gene_symbols, tf_tg=None, flat=True, standardized=False, n_jobs=-1):
     """
     Computes the lists of TF-TG and TG-TG correlations
     :param expr: matrix of gene expressions. Shape=(nb_samples, nb_genes)
     :param gene_symbols: list of gene symbols matching the expr matrix. Shape=(nb_genes,)
     :param tf_tg: dict with TF symbol as key and list of TGs' symbols as value
     :param flat: whether to return flat lists
+    :param standardized: whether expr is already standardized (zero mean and unit variance genes)
+    :param n_jobs: number of threads used to process the TFs (-1 to use all the cores)
     :return: lists of TF-TG and TG-TG correlations, respectively
     """
     if tf_tg is None:
         tf_tg = tf_tg_interactions()
-    gene_symbols = np.array(gene_symbols)
-
-    tf_tg_corr = []
-    tg_tg_corr = []
-    for tf, tgs in tf_tg.items():
-        tg_idxs = np.array([np.where(gene_symbols == tg)[0] for tg in tgs if tg in gene_symbols]).ravel()
-
-        if tf in gene_symbols and len(tg_idxs) > 0:
-            # TG-TG correlations
-            expr_tgs = expr[:, tg_idxs]
-            corr = correlations_list(expr_tgs, expr_tgs)
-            tg_tg_corr += [corr.tolist()]
-
-            # TF-TG correlations
-            tf_idx = np.argwhere(gene_symbols == tf)[0]
-            expr_tf = expr[:, tf_idx]
-            corr = pearson_correlation(expr_tf[:, None], expr_tgs).ravel()
-            tf_tg_corr += [corr.tolist()]
+    tf_tg_corr, tg_tg_corr = _tf_tg_corr_arrays(expr, gene_symbols, tf_tg, standardized, n_jobs)
+    tf_tg_corr = [corr.tolist() for corr in tf_tg_corr]
+    tg_tg_corr = [corr.tolist() for corr in tg_tg_corr]
 
     # Flatten list
     if flat:
@@ -941,6 +1096,19 @@ def compute_tf_tg_corrs(expr, gene_symbols, tf_tg=None, flat=True):
     return tf_tg_corr, tg_tg_corr
 
 
+def _psi_coefficient(tf_tg_pairs, weights_type='nb_genes'):
+    """
+    Computes the psi TF-TG correlation coefficient from the TF-TG correlations flattened by _flatten_pairs.
+    See psi_coefficient
+    """
+    flat_x, flat_z, offsets, sizes = tf_tg_pairs
+    weights = np.ones(len(sizes))
+    if weights_type == 'nb_genes':
+        weights = sizes.astype(np.float64)  # nb. of genes regulated by the TF
+    sims = _cosine_similarities(flat_x, flat_z, offsets)
+    return np.dot(weights, sims) / weights.sum()
+
+
 def psi_coefficient(tf_tg_x, tf_tg_z, weights_type='nb_genes'):
     """
     Computes the psi TF-TG correlation coefficient
@@ -950,17 +1118,22 @@ def psi_coefficient(tf_tg_x, tf_tg_z, weights_type='nb_genes'):
                     target genes that it regulates. For 'ones' the weights are all one.
     :return: psi correlation coefficient
     """
-    weights_sum = 0
-    total_sum = 0
-    for cx, cz in zip(tf_tg_x, tf_tg_z):
-        weight = 1
-        if weights_type == 'nb_genes':
-            weight = len(cx)  # nb. of genes regulated by the TF
-        weights_sum += weight
-        cx = np.array(cx)
-        cz = np.array(cz)
-        total_sum += weight * cosine_similarity(cx, cz)
-    return total_sum / weights_sum
+    return _psi_coefficient(_flatten_pairs(tf_tg_x, tf_tg_z), weights_type)
+
+
+def _phi_coefficient(tg_tg_pairs, weights_type='nb_genes'):
+    """
+    Computes the phi TG-TG correlation coefficient from the TG-TG correlations flattened by _flatten_pairs.
+    See phi_coefficient
+    """
+    # In case a TF only regulates one gene, its list is empty and was skipped by _flatten_pairs
+    flat_x, flat_z, offsets, sizes = tg_tg_pairs
+    weights = np.ones(len(sizes))
+    if weights_type == 'nb_genes':
+        # nb. of genes regulated by the TF, positive root of nb_genes * (nb_genes + 1) = 2*len(cx)
+        weights = 0.5 * (np.sqrt(1 + 8 * sizes) - 1)
+    sims = _cosine_similarities(flat_x, flat_z, offsets)
+    return np.dot(weights, sims) / weights.sum()
 
 
 def phi_coefficient(tg_tg_x, tg_tg_z, weights_type='nb_genes'):
@@ -972,20 +1145,7 @@ def phi_coefficient(tg_tg_x, tg_tg_z, weights_type='nb_genes'):
                     target genes that it regulates. For 'ones' the weights are all one.
     :return: theta correlation coefficient
     """
-    weights_sum = 0
-    total_sum = 0
-    for cx, cz in zip(tg_tg_x, tg_tg_z):
-        if len(cx) > 0:  # In case a TF only regulates one gene, the list will be empty
-            weight = 1
-            if weights_type == 'nb_genes':
-                x = len(cx)  # nb_genes * (nb_genes + 1) = 2*weight
-                roots = np.roots([1, 1, -2 * x])
-                weight = max(roots)  # nb. of genes regulated by the TF
-            weights_sum += weight
-            cx = np.array(cx)
-            cz = np.array(cz)
-            total_sum += weight * cosine_similarity(cx, cz)
-    return total_sum / weights_sum
+    return _phi_coefficient(_flatten_pairs(tg_tg_x, tg_tg_z), weights_type)
 
 
 def compute_scores(expr_x, expr_z, gene_symbols):
@@ -996,20 +1156,26 @@ def compute_scores(expr_x, expr_z, gene_symbols):
     :param gene_symbols: list of gene symbols (the genes dimension is sorted according to this list). Shape=(nb_genes,)
     :return: list of evaluation coefficients (S_dist, S_dend, S_sdcc, S_tftg, S_tgtg)
     """
+    # Standardize both datasets once, in single precision. All the scores are correlation-based, so they
+    # are invariant to this transformation
+    expr_x = standardize(expr_x).astype(np.float32)
+    expr_z = standardize(expr_z).astype(np.float32)
+
     # Gamma coefficients
-    gamma_dx_dz, gamma_dx_tx, gamma_dz_tz, gamma_tx_tz = gamma_coefficients(expr_x, expr_z)
+    gamma_dx_dz, gamma_dx_tx, gamma_dz_tz, gamma_tx_tz = gamma_coefficients(expr_x, expr_z, standardized=True)
 
-    # Psi and phi coefficients
-    r_tf_tg_corr, r_tg_tg_corr = compute_tf_tg_corrs(expr_x, gene_symbols, flat=False)
-    s_tf_tg_corr, s_tg_tg_corr = compute_tf_tg_corrs(expr_z, gene_symbols, flat=False)
-    psi_dx_dz = psi_coefficient(r_tf_tg_corr, s_tf_tg_corr)
-    phi_dx_dz = phi_coefficient(r_tg_tg_corr, s_tg_tg_corr)
+    # Psi and phi coefficients. The per-TF correlations are flattened into contiguous buffers once
+    tf_tg = tf_tg_interactions()
+    r_tf_tg_corr, r_tg_tg_corr = _tf_tg_corr_arrays(expr_x, gene_symbols, tf_tg, standardized=True)
+    s_tf_tg_corr, s_tg_tg_corr = _tf_tg_corr_arrays(expr_z, gene_symbols, tf_tg, standardized=True)
+    psi_dx_dz = _psi_coefficient(_flatten_pairs(r_tf_tg_corr, s_tf_tg_corr))
+    phi_dx_dz = _phi_coefficient(_flatten_pairs(r_tg_tg_corr, s_tg_tg_corr))
 
-    return [gamma_dx_dz,
-            gamma_tx_tz,
-            (gamma_dx_tx - gamma_dz_tz) ** 2,
-            psi_dx_dz,
-            phi_dx_dz]
+    return [float(gamma_dx_dz),
+            float(gamma_tx_tz),
+            float((gamma_dx_tx - gamma_dz_tz) ** 2),
+            float(psi_dx_dz),
+            float(phi_dx_dz)]
 
 
 # ---------------------
@@ -1032,33 +1198,6 @@ def hierarchical_clustering(data, corr_fun=pearson_correlation):
     return l_matrix
 
 
-class Cluster:
-    """
-    Auxiliary class to store binary clusters
-    """
-
-    def __init__(self, c_left=None, c_right=None, index=None):
-        assert (index is not None) ^ (c_left is not None and c_right is not None)
-        self._c_left = c_left
-        self._c_right = c_right
-        if index is not None:
-            self._indices = [index]
-        else:
-            self._indices = c_left.indices + c_right.indices
-
-    @property
-    def indices(self):
-        return self._indices
-
-    @property
-    def c_left(self):
-        return self._c_left
-
-    @property
-    def c_right(self):
-        return self._c_right
-
-
 def dendrogram_distance(l_matrix, condensed=True):
     """
     Computes the distances between each pair of genes according to the scipy linkage
@@ -1068,28 +1207,11 @@ def dendrogram_distance(l_matrix, condensed=True):
            upper-triangular of the distance matrix
     :return: distances
     """
-    nb_genes = l_matrix.shape[0] + 1
-
-    # Fill distance matrix m
-    clusters = {i: Cluster(index=i) for i in range(nb_genes)}
-    m = np.zeros((nb_genes, nb_genes))
-    for i, z in enumerate(l_matrix):
-        c1, c2, dist, n_elems = z
-        clusters[nb_genes + i] = Cluster(c_left=clusters[c1],
-                                         c_right=clusters[c2])
-        c1_indices = clusters[c1].indices
-        c2_indices = clusters[c2].indices
-
-        for c1_idx in c1_indices:
-            for c2_idx in c2_indices:
-                m[c1_idx, c2_idx] = dist
-                m[c2_idx, c1_idx] = dist
-
-    # Return flat array if condensed
+    # The distance between two genes is the height of the cluster where they are merged
+    dists = cophenet(l_matrix)
     if condensed:
-        return upper_diag_list(m)
-
-    return m
+        return dists
+    return squareform(dists)
 
 
 def compare_cophenetic(l_matrix1, l_matrix2):
@@ -1099,16 +1221,52 @@ def compare_cophenetic(l_matrix1, l_matrix2):
     :param l_matrix2: Scipy linkage matrix. Shape=(nb_genes-1, 4)
     :return: cophenic distance between two dendrograms
     """
-    dists1 = dendrogram_distance(l_matrix1, condensed=True)
-    dists2 = dendrogram_distance(l_matrix2, condensed=True)
-
-    return pearson_correlation(dists1, dists2)
+    return pearson_correlation(cophenet(l_matrix1), cophenet(l_matrix2))
 
 
 # ---------------------
 # PLOTTING UTILITIES
 # ---------------------
 
+def _plot_kdes(datasets, labels, line_kws, ax=None, bw_method=.15, cut=3, gridsize=200):
+    """
+    Plots the Gaussian kernel density estimates of several datasets, evaluated on a shared grid
+    :param datasets: list of 1-d arrays of numbers
+    :param labels: label for each dataset
+    :param line_kws: dict of matplotlib line properties for each dataset
+    :param ax: matplotlib axes
+    :param bw_method: bandwidth of the kernels, as in scipy.stats.gaussian_kde
+    :param cut: the grid extends this number of bandwidths past the extreme data points
+    :param gridsize: number of points in the grid
+    :return matplotlib axes
+    """
+    if ax is None:
+        ax = plt.gca()
+
+    # A Gaussian KDE cannot be fitted to data without variance
+    kept = []
+    for x, label, kws in zip(datasets, labels, line_kws):
+        if len(x) == 0 or np.ptp(x) == 0:
+            print('Warning: data of {} has zero variance, its density will not be plotted'.format(label))
+        else:
+            kept.append((x, label, kws))
+    if len(kept) == 0:
+        return ax
+    datasets, labels, line_kws = zip(*kept)
+
+    kdes = [scipy.stats.gaussian_kde(x, bw_method=bw_method) for x in datasets]
+
+    # Shared grid covering all datasets
+    bws = [np.sqrt(kde.covariance[0, 0]) for kde in kdes]
+    grid_min = min(np.min(x) - cut * bw for x, bw in zip(datasets, bws))
+    grid_max = max(np.max(x) + cut * bw for x, bw in zip(datasets, bws))
+    grid = np.linspace(grid_min, grid_max, gridsize)
+
+    for kde, label, kws in zip(kdes, labels, line_kws):
+        ax.plot(grid, kde(grid), label=label, **kws)
+    return ax
+
+
 def plot_distribution(data, label, color='royalblue', linestyle='-', ax=None, plot_legend=True,
                       xlabel=None, ylabel=None):
     """
@@ -1124,11 +1282,7 @@ def plot_distribution(data, label, color='royalblue', linestyle='-', ax=None, pl
     :return matplotlib axes
     """
     x = np.ravel(data)
-    ax = sns.distplot(x,
-                      hist=False,
-                      kde_kws={'linestyle': linestyle, 'color': color, 'linewidth': 2, 'bw': .15},
-                      label=label,
-                      ax=ax)
+    ax = _plot_kdes([x], [label], [{'linestyle': linestyle, 'color': color, 'linewidth': 2}], ax=ax)
     if plot_legend:
         plt.legend()
     if xlabel is not None:
@@ -1216,12 +1370,9 @@ def plot_intensities(expr, plot_quantiles=True, dataset_name='E. coli M3D', colo
     :param ax: matplotlib axes
     :return matplotlib axes
     """
-    x = np.ravel(expr)
-    ax = sns.distplot(x,
-                      hist=False,
-                      kde_kws={'color': color, 'linewidth': 2, 'bw': .15},
-                      label=dataset_name,
-                      ax=ax)
+    datasets = [np.ravel(expr)]
+    labels = [dataset_name]
+    line_kws = [{'color': color, 'linewidth': 2}]
 
     if plot_quantiles:
         stds = np.std(expr, axis=-1)
@@ -1229,20 +1380,17 @@ def plot_intensities(expr, plot_quantiles=True, dataset_name='E. coli M3D', colo
         cut_point = int(0.05 * len(idxs))
 
         q95_idxs = idxs[-cut_point]
-        x = np.ravel(expr[q95_idxs, :])
-        ax = sns.distplot(x,
-                          ax=ax,
-                          hist=False,
-                          kde_kws={'linestyle': ':', 'color': color, 'linewidth': 2, 'bw': .15},
-                          label='High variance {}'.format(dataset_name))
+        datasets.append(np.ravel(expr[q95_idxs, :]))
+        labels.append('High variance {}'.format(dataset_name))
+        line_kws.append({'linestyle': ':', 'color': color, 'linewidth': 2})
 
         q5_idxs = idxs[:cut_point]
-        x = np.ravel(expr[q5_idxs, :])
-        sns.distplot(x,
-                     ax=ax,
-                     hist=False,
-                     kde_kws={'linestyle': '--', 'color': color, 'linewidth': 2, 'bw': .15},
-                     label='Low variance {}'.format(dataset_name))
+        datasets.append(np.ravel(expr[q5_idxs, :]))
+        labels.append('Low variance {}'.format(dataset_name))
+        line_kws.append({'linestyle': '--', 'color': color, 'linewidth': 2})
+
+    # All the densities are evaluated on the same grid
+    ax = _plot_kdes(datasets, labels, line_kws, ax=ax)
     plt.legend()
     plt.xlabel('Absolute levels')
     plt.ylabel('Density')
@@ -1259,16 +1407,14 @@ def plot_gene_ranges(expr, dataset_name='E. coli M3D', color='royalblue', ax=Non
     :return matplotlib axes
     """
     nb_samples, nb_genes = expr.shape
-    sorted_expr = [np.sort(expr[:, gene]) for gene in range(nb_genes)]
-    sorted_expr = np.array(sorted_expr)  # Shape=(nb_genes, nb_samples)
     cut_point = int(0.05 * nb_samples)
-    diffs = sorted_expr[:, -cut_point] - sorted_expr[:, cut_point]
 
-    ax = sns.distplot(diffs,
-                      hist=False,
-                      kde_kws={'color': color, 'linewidth': 2, 'bw': .15},
-                      label=dataset_name,
-                      ax=ax)
+    # Partial sorts of all genes at once. Only the two quantile positions are needed
+    lo = np.partition(expr, cut_point, axis=0)[cut_point, :]
+    hi = np.partition(expr, -cut_point, axis=0)[-cut_point, :]
+    diffs = hi - lo
+
+    ax = _plot_kdes([diffs], [dataset_name], [{'color': color, 'linewidth': 2}], ax=ax)
 
     plt.xlabel('Gene ranges')
     plt.ylabel('Density')
@@ -1309,7 +1455,116 @@ def plot_difference_histogram(interest_distr, background_distr, xlabel, left_lim
     return ax
 
 
-def find_chip_rates(expr, gene_symbols, tf_tg=None):
+def _rank_sum_var_base(ranks):
+    """
+    Computes the tie-corrected factor of the variance of the Mann-Whitney U statistic for each sample. It only depends
+    on the ties within each sample, so it is shared by all groups of genes: var(U) = n1 * n2 / 12 * var_base
+    :param ranks: ranks of the genes within each sample. Shape=(nb_samples, nb_genes)
+    :return: np.array with var_base for each sample. Shape=(nb_samples,)
+    """
+    n = ranks.shape[1]
+    ties = np.array([np.sum(t ** 3 - t) for t in
+                     (np.unique(r, return_counts=True)[1].astype(np.float64) for r in ranks)])
+    return (n + 1) - ties / (n * (n - 1))
+
+
+def _rank_sum_p_values(ranks, idxs, var_base=None):
+    """
+    Computes the two-sided Wilcoxon's rank-sum (Mann-Whitney U) p-values of a group of genes against the remaining
+    genes, for every sample at once. As scipy.stats.mannwhitneyu's 'auto' method, uses the exact null distribution when
+    one of the groups has at most 8 genes and the sample has no ties, and the normal approximation with tie and
+    continuity corrections otherwise
+    :param ranks: ranks of the genes within each sample. Shape=(nb_samples, nb_genes)
+    :param idxs: indices of the genes in the group of interest. Shape=(n1,)
+    :param var_base: tie-corrected variance factor of each sample, as returned by _rank_sum_var_base. Computed
+           from ranks if None
+    :return: np.array of p-values. Shape=(nb_samples,)
+    """
+    n = ranks.shape[1]
+    if var_base is None:
+        var_base = _rank_sum_var_base(ranks)
+
+    # The group of interest and the remaining genes split the genes, even if idxs contains duplicates
+    mask = np.zeros(n, dtype=bool)
+    mask[idxs] = True
+    n1 = np.count_nonzero(mask)
+    n2 = n - n1
+
+    # U statistic of the group of interest, obtained from its rank sum
+    u1 = ranks[:, mask].sum(axis=1) - n1 * (n1 + 1) / 2
+    mu = n1 * n2 / 2
+
+    # Standard deviation of U, corrected for ties
+    sigma = np.sqrt(n1 * n2 / 12 * var_base)
+
+    z = (np.abs(u1 - mu) - 0.5) / sigma
+    p_values = np.clip(2 * scipy.stats.norm.sf(z), 0, 1)
+
+    # Small groups: the approximation cannot reach the extreme p-values, use the exact distribution instead
+    if min(n1, n2) <= 8:
+        no_ties = var_base == n + 1  # The tie term is exactly 0
+        if np.any(no_ties):
+            # Without ties the ranks are integers, and so is U
+            u = np.maximum(u1[no_ties], n1 * n2 - u1[no_ties]).astype(np.int64)
+            p_values[no_ties] = np.minimum(2 * _exact_u_sf(min(n1, n2), max(n1, n2))[u], 1)
+    return p_values
+
+
+@lru_cache(maxsize=32)
+def _exact_u_sf(n1, n2):
+    """
+    Computes the survival function of the exact null distribution of the Mann-Whitney U statistic, without ties. The
+    number of ways to get each U value are the coefficients of the Gaussian binomial coefficient (n1 + n2 choose n1),
+    which are built with exact integers at a cost of O(n1^2 * n2)
+    :param n1: size of the smaller group
+    :param n2: size of the larger group
+    :return: read-only np.array with P(U >= u) for each u in [0, n1 * n2]. Shape=(n1 * n2 + 1,)
+    """
+    size = n1 * n2 + 1
+    counts = np.zeros(size, dtype=object)
+    counts[0] = 1
+    for i in range(1, n1 + 1):
+        # Multiply by (1 - q^(n2 + i)), then divide by (1 - q^i)
+        k = n2 + i
+        if k < size:
+            counts[k:] = counts[k:] - counts[:size - k]
+        for j in range(i):
+            counts[j::i] = np.cumsum(counts[j::i])
+    sf = np.cumsum(counts[::-1])[::-1]
+    sf = (sf / sf[0]).astype(np.float64)
+    sf.flags.writeable = False
+    return sf
+
+
+def _score_tf(tf, tgs, ranks, var_base, sym2idx):
+    """
+    Computes the fraction of samples in which the TGs of a TF exhibit significant rank differences in comparison with
+    other non-target genes
+    :param tf: TF symbol
+    :param tgs: list of TGs' symbols regulated by tf
+    :param ranks: ranks of the genes within each sample. Shape=(nb_samples, nb_genes)
+    :param var_base: tie-corrected variance factor of each sample, as returned by _rank_sum_var_base
+    :param sym2idx: dict with gene symbol as key and its index in ranks as value
+    :return: chip rate and weight (number of distinct TGs regulated by tf), or None if tf or all its TGs are not in
+             sym2idx
+    """
+    # Repeated TGs are counted once, both in the test and in the weight
+    tg_idxs = np.unique(np.fromiter((sym2idx[tg] for tg in tgs if tg in sym2idx), dtype=np.intp))
+    if tf not in sym2idx or len(tg_idxs) == 0:
+        return None
+
+    # Compute Wilcoxon's p-value for each sample, TGs regulated by TF vs. other genes
+    p_values = _rank_sum_p_values(ranks, tg_idxs, var_base)
+
+    # Correct the independent p-values to account for multiple testing with Benjamini-Hochberg's procedure
+    reject, p_values_c, _, _ = multipletests(pvals=p_values,
+                                             alpha=0.05,
+                                             method='fdr_bh')
+    chip_rate = np.sum(reject) / ranks.shape[0]
+    return chip_rate, len(tg_idxs)
+
+
+def find_chip_rates(expr, gene_symbols, tf_tg=None, n_jobs=-1):
     """
     Plots the TF activity histogram. It is computed according to the Wilcoxon's non parametric rank-sum method, which tests
     whether TF targets exhibit significant rank differences in comparison with other non-target genes. The obtained
@@ -1317,48 +1572,27 @@ def find_chip_rates(expr, gene_symbols, tf_tg=None):
     :param expr: matrix of gene expressions. Shape=(nb_samples, nb_genes)
     :param gene_symbols: list of gene_symbols. Shape=(nb_genes,)
     :param tf_tg: dict with TF symbol as key and list of TGs' symbols as value
+    :param n_jobs: number of threads used to process the TFs (-1 to use all the cores)
     :return np.array of chip rates, and weights (for each TF, number of TGs it regulates)
     """
-    nb_samples, nb_genes = expr.shape
-
     if tf_tg is None:
         tf_tg = tf_tg_interactions()
-    gene_symbols = np.array(gene_symbols)
+    sym2idx = {s: i for i, s in enumerate(gene_symbols)}
 
     # Normalize expression data
     expr_norm = (expr - np.mean(expr, axis=0)) / np.std(expr, axis=0)
 
+    # Rank the genes within each sample. The ranks and their ties do not depend on the TF, so they are computed once
+    ranks = scipy.stats.rankdata(expr_norm, axis=1)
+    var_base = _rank_sum_var_base(ranks)
+
     # For each TF, check whether its target genes exhibit significant rank differences in comparison with other
-    # non-target genes.
-    active_tfs = []
-    weights = []
-    for tf, tgs in tf_tg.items():
-        tg_idxs = np.array([np.where(gene_symbols == tg)[0] for tg in tgs if tg in gene_symbols]).ravel()
-
-        if tf in gene_symbols and len(tg_idxs) > 0:
-            # Add weight
-            weights.append(len(tg_idxs))
-
-            # Find expressions of TG regulated by TF
-            expr_tgs = expr_norm[:, tg_idxs]
-
-            # Find expressions of other genes
-            non_tg_idxs = list(set(range(nb_genes)) - set(tg_idxs.tolist()))
-            expr_non_tgs = expr_norm[:, non_tg_idxs]
-
-            # Compute Wilcoxon's p-value for each sample
-            p_values = []
-            for i in range(nb_samples):
-                statistic, p_value = scipy.stats.mannwhitneyu(expr_tgs[i, :], expr_non_tgs[i, :],
-                                                              alternative='two-sided')
-                p_values.append(p_value)
-
-            # Correct the independent p-values to account for multiple testing with Benjamini-Hochberg's procedure
-            reject, p_values_c, _, _ = multipletests(pvals=p_values,
-                                                     alpha=0.05,
-                                                     method='fdr_bh')
-            chip_rate = np.sum(reject) / nb_samples
-            active_tfs.append(chip_rate)
+    # non-target genes. TFs are independent from each other
+    results = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(_score_tf)(tf, tgs, ranks, var_base, sym2idx)
+                                                        for tf, tgs in tf_tg.items())
+    results = [r for r in results if r is not None]
+    active_tfs = [r[0] for r in results]
+    weights = [r[1] for r in results]
 
     return np.array(active_tfs), np.array(weights)
 